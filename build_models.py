@@ -0,0 +1,29 @@
+"""Generates _generated_models.py from the installed openai package.
+
+Run this again whenever openai is upgraded so `howto --setmodel` can validate
+model names without importing openai.
+"""
+
+import os
+
+from openai.types import ChatModel
+from typing_extensions import get_args
+
+OUTPUT_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "_generated_models.py"
+)
+
+
+def main() -> None:
+    models = sorted(set(get_args(ChatModel)))
+    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
+        f.write("# Generated by build_models.py, do not edit.\n")
+        f.write("VALID_MODELS = frozenset(\n    {\n")
+        for model in models:
+            f.write(f"        {model!r},\n")
+        f.write("    }\n)\n")
+    print(f"Wrote {len(models)} models to {OUTPUT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Bundles howto and its dependencies into a single executable zipapp.
+
+Requires shiv (`pip install shiv`). The result is written to dist/howto and
+can be copied anywhere on your $PATH. Run build_models.py first so the
+bundle can validate model names without importing openai.
+
+The bundle contains compiled wheels built for the interpreter running this
+script, so it is pinned to that interpreter via its shebang.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_FILE = os.path.join(ROOT, "dist", "howto")
+SOURCES = ["main.py", "_generated_models.py"]
+
+
+def main() -> None:
+    os.makedirs(os.path.dirname(OUTPUT_FILE), exist_ok=True)
+    with tempfile.TemporaryDirectory() as staging:
+        for source in SOURCES:
+            path = os.path.join(ROOT, source)
+            if os.path.exists(path):
+                shutil.copy(path, staging)
+
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "shiv",
+                "-r",
+                os.path.join(ROOT, "requirements.txt"),
+                "--site-packages",
+                staging,
+                "-e",
+                "main:cli",
+                "-p",
+                sys.executable,
+                "-o",
+                OUTPUT_FILE,
+            ],
+            check=True,
+        )
+    print(f"Wrote {OUTPUT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
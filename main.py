@@ -1,108 +1,279 @@
+import functools
 import json
 import os
 import sys
-import textwrap
-from configparser import ConfigParser
 from typing import Optional
 
-from openai import OpenAI
-from openai.types import ChatModel
-from typing_extensions import get_args
+try:
+    import orjson
 
-KEY = os.getenv("OPENAI_HOWTO_TOKEN")
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
 
-if KEY is None:
-    raise ValueError("No token found in environment variables.")
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
-CLIENT = OpenAI(api_key=KEY)
 
-HOWTO_DIR = os.path.expanduser("~/.howto/")
-HISTORY_FILE = HOWTO_DIR + "history.json"
-CONFIG_FILE = HOWTO_DIR + "config.ini"
-USERINFO_FILE = HOWTO_DIR + "userinfo.txt"
+KEY = os.getenv("OPENAI_HOWTO_TOKEN")
 
-os.makedirs(HOWTO_DIR, exist_ok=True)
+# the openai import chain is slow, so only pay for it when a query is issued.
+# continuous mode starts it on a daemon thread while the user types
+_CLIENT = None
+_CLIENT_THREAD = None
+_CLIENT_ERROR: Optional[Exception] = None
 
 
-def load_history() -> list:
-    if not os.path.exists(HISTORY_FILE):
-        return []
-    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+def _make_client():
+    if KEY is None:
+        raise ValueError("No token found in environment variables.")
+    from openai import OpenAI
 
+    return OpenAI(api_key=KEY)
+
+
+def _prefetch_target() -> None:
+    global _CLIENT, _CLIENT_ERROR
+    try:
+        _CLIENT = _make_client()
+    except Exception as e:
+        _CLIENT_ERROR = e
+
+
+def _prefetch_client() -> None:
+    global _CLIENT_THREAD
+    if _CLIENT is not None or _CLIENT_THREAD is not None:
+        return
+    import threading
+
+    # daemon so quitting before the import finishes doesn't wait on it
+    _CLIENT_THREAD = threading.Thread(target=_prefetch_target, daemon=True)
+    _CLIENT_THREAD.start()
+
+
+def _client():
+    global _CLIENT
+    if _CLIENT_THREAD is not None:
+        _CLIENT_THREAD.join()
+        if _CLIENT_ERROR is not None:
+            raise _CLIENT_ERROR
+    if _CLIENT is None:
+        _CLIENT = _make_client()
+    return _CLIENT
+
+
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": "You are an assistant contacted via a 'howto' CLI command. Questions may be formatted weirdly. If so, assume each question is preceded with 'how to' or similar. If the question can be answered in one or two sentences without immediately important information, keep responses short.",
+}
+
+HOME = os.environ.get("HOME") or os.path.expanduser("~")
+HOWTO_DIR = f"{HOME}/.howto/"
+# history now lives in CONFIG_FILE; this is only read to migrate old installs
+HISTORY_FILE = f"{HOWTO_DIR}history.json"
+CONFIG_FILE = f"{HOWTO_DIR}config.json"
+# only read to migrate old installs
+LEGACY_CONFIG_FILE = f"{HOWTO_DIR}config.ini"
+USERINFO_FILE = f"{HOWTO_DIR}userinfo.txt"
+
+# query the terminal once; piped output skips the ioctl and uses a fixed width
+_TERM_W = (os.get_terminal_size().columns - 6) if sys.stdout.isatty() else 74
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # write to a sibling file and rename it over the original so an
+    # interrupted write never leaves a truncated file behind. the pid keeps
+    # concurrent howto processes from sharing a temp file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    try:
+        fd = os.open(tmp, flags, 0o644)
+    except FileNotFoundError:
+        # HOWTO_DIR is only created the first time something is saved
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        fd = os.open(tmp, flags, 0o644)
+    try:
+        try:
+            # os.write may write less than asked for, so loop until it's all out
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class DirtyConfig(dict):
+    """Config sections keyed by name that remember whether they have been
+    modified since loading."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._dirty = False
+        # set while the files used by older versions may still need migrating
+        self._legacy = False
+
+
+def load_config() -> DirtyConfig:
+    try:
+        with open(CONFIG_FILE, "rb") as f:
+            config = DirtyConfig(_json_loads(f.read()))
+    except FileNotFoundError:
+        config = _migrate_config()
+        config._legacy = True
 
-def save_history(history) -> None:
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f)
+    model = config.setdefault("ai model", {})
+    model.setdefault("model", "gpt-4o-mini")
+    model.setdefault("history", "6")
 
+    user_info = config.setdefault("user info", {})
+    user_info.setdefault("globalcontext", "[User has not set any userinfo]")
 
-def load_config() -> ConfigParser:
-    config = ConfigParser()
-    config.read(CONFIG_FILE)
+    config.setdefault("project context", {})
+    config.setdefault("legacy project context", {})
 
-    if not config.has_section("ai model"):
-        config.add_section("ai model")
-    if not config.has_option("ai model", "model"):
-        config["ai model"]["model"] = "gpt-4o-mini"
-    if not config.has_option("ai model", "history"):
-        config["ai model"]["history"] = "6"
+    # the old history file is only read once something needs the history
+    if "data" not in config.setdefault("history", {}):
+        config._legacy = True
 
-    if not config.has_section("user info"):
-        config.add_section("user info")
-    if not config.has_option("user info", "globalcontext"):
-        config["user info"]["globalcontext"] = "[User has not set any userinfo]"
+    return config
 
-    if not config.has_section("project context"):
-        config.add_section("project context")
 
+def _migrate_config() -> DirtyConfig:
+    # older versions kept the config in an ini file
+    try:
+        f = open(LEGACY_CONFIG_FILE, "r", encoding="utf-8")
+    except FileNotFoundError:
+        return DirtyConfig()
+
+    from configparser import ConfigParser
+
+    parser = ConfigParser(interpolation=None)
+    parser.optionxform = str
+    with f:
+        parser.read_file(f)
+    config = DirtyConfig(
+        {
+            section: dict(parser.items(section, raw=True))
+            for section in parser.sections()
+        }
+    )
+    # ConfigParser lowercased every directory it stored, and the real spelling
+    # can't be recovered, so these are kept apart and matched case-insensitively
+    if "project context" in config:
+        config["legacy project context"] = config.pop("project context")
+    if "data" in config.get("history", {}):
+        try:
+            config["history"]["data"] = _json_loads(config["history"]["data"])
+        except ValueError:
+            config["history"]["data"] = []
+    config._dirty = True
     return config
 
 
-def save_config(config: ConfigParser) -> None:
-    with open(CONFIG_FILE, "w") as f:
-        config.write(f)
+def save_config(config: DirtyConfig) -> None:
+    if not config._dirty:
+        return
+    if config._legacy:
+        # pull in the old history before its file is retired below
+        load_history(config)
+    _write_atomic(CONFIG_FILE, _json_dumps(config))
+    config._dirty = False
+    if config._legacy:
+        _retire_legacy_files()
+        config._legacy = False
 
 
-def set_userinfo(config: ConfigParser, userinfo: str) -> None:
+def _retire_legacy_files() -> None:
+    # rename rather than delete, but get them out of the way so removing
+    # config.json later doesn't resurrect old settings and history
+    for path in (LEGACY_CONFIG_FILE, HISTORY_FILE):
+        try:
+            os.replace(path, f"{path}.bak")
+        except FileNotFoundError:
+            pass
+
+
+def _load_legacy_history() -> list:
+    try:
+        with open(HISTORY_FILE, "rb") as f:
+            return _json_loads(f.read())
+    except FileNotFoundError:
+        return []
+    except ValueError:
+        # older versions wrote this file non-atomically, so it may be truncated
+        return []
+
+
+def load_history(config: DirtyConfig) -> list:
+    history = config["history"]
+    if "data" not in history:
+        history["data"] = _load_legacy_history()
+    return history["data"]
+
+
+def save_history(config: DirtyConfig, history: list) -> None:
+    if history == config["history"].get("data"):
+        return
+    config["history"]["data"] = history
+    config._dirty = True
+
+
+def set_userinfo(config: DirtyConfig, userinfo: str) -> None:
     config["user info"]["globalcontext"] = userinfo
+    config._dirty = True
 
 
-def get_userinfo(config: ConfigParser) -> str:
+def get_userinfo(config: DirtyConfig) -> str:
     return config["user info"]["globalcontext"]
 
 
-def set_history_length(config: ConfigParser, length: str) -> None:
+def set_history_length(config: DirtyConfig, length: str) -> None:
     config["ai model"]["history"] = length
+    config._dirty = True
 
 
-def get_history_length(config: ConfigParser) -> str:
+def get_history_length(config: DirtyConfig) -> str:
     return config["ai model"]["history"]
 
 
-def set_model(config: ConfigParser, model: str) -> None:
+def set_model(config: DirtyConfig, model: str) -> None:
     config["ai model"]["model"] = model
+    config._dirty = True
 
 
-def get_model(config: ConfigParser) -> str:
+def get_model(config: DirtyConfig) -> str:
     return config["ai model"]["model"]
 
 
 def set_project_context(
-    config: ConfigParser, directory: str, context: Optional[str]
+    config: DirtyConfig, directory: str, context: Optional[str]
 ) -> None:
+    config["legacy project context"].pop(directory.lower(), None)
     if context is None:
-        config.remove_option("project context", directory)
+        config["project context"].pop(directory, None)
     else:
         config["project context"][directory] = context
+    config._dirty = True
 
 
-def get_project_context(config: ConfigParser, directory: str) -> str:
-    return config["project context"].get(directory, "[The user has not set context]")
+def get_project_context(config: DirtyConfig, directory: str) -> str:
+    context = config["project context"].get(directory)
+    if context is None:
+        context = config["legacy project context"].get(
+            directory.lower(), "[The user has not set context]"
+        )
+    return context
 
 
-def print_help() -> None:
-    print(
-        f"""
+_HELP_TEXT = f"""
 Usage: howto [question] [OPTIONS] [--help, -h]
 
 
@@ -116,7 +287,7 @@ Query's Openai's api for information about any given question.
 
 --printhistory, -ph         Formats and prints the history.          
 
---clearhistory, -ch         Clears the local history (located in {HISTORY_FILE}).
+--clearhistory, -ch         Clears the local history (located in {CONFIG_FILE}).
 
 --setuserinfo, -su          Sets the userinfo--information that is always prepended
                             to the bot's memory.
@@ -131,158 +302,266 @@ Query's Openai's api for information about any given question.
                             'quit' is entered.
 
 --help, -h                  Prints this message.
+
 """
-    )
-    sys.exit(1)
 
 
-def main() -> None:
-    config = load_config()
-    arg1 = sys.argv[1] if len(sys.argv) > 1 else None
-    arg2 = sys.argv[2] if len(sys.argv) > 2 else None
-    if arg1 is not None and arg1.startswith("-"):
-        if arg1 in ["--help", "-h"]:
-            print_help()
-        elif arg1 in ["--clearhistory", "-ch"]:
-            save_history([])
-            print("Cleared history.")
-            sys.exit(1)
-        elif arg1 == "--setmodel":
-            if arg2 is None:
-                print(f"Current model is: '{get_model(config)}'")
-                sys.exit(1)
-
-            valid_models = get_args(ChatModel)
-            if arg2 not in valid_models:
-                print(f"Invalid model: '{arg2}'")
-                print(f"Must be one of:\n{'\n'.join(valid_models)}")
-                sys.exit(1)
-
-            set_model(config, arg2)
-            save_config(config)
-            print(f"Model set to: '{get_model(config)}'")
-            sys.exit(1)
-        elif arg1 == "--sethistory":
-            if arg2 is None:
-                print(f"History length is: {get_history_length(config)}")
-                sys.exit(1)
-
-            if not arg2.isdigit():
-                print(f"History length must be a number.")
-                sys.exit(1)
-
-            set_history_length(config, arg2)
-            save_config(config)
-            print(f"History length set to: {get_history_length(config)}")
-            sys.exit(1)
-        elif arg1 in ["--printhistory", "-ph"]:
-            wrapper = textwrap.TextWrapper(
-                width=os.get_terminal_size().columns - 6, drop_whitespace=False
-            )
-            for entry in load_history():
-                if entry["role"] != "assistant":
-                    for line in wrapper.wrap(entry["content"]):
-                        print(f"# {line}")
-                else:
-                    for line in entry["content"].split("\n"):
-                        for line2 in wrapper.wrap(line):
-                            print(f"   # {line2}")
-            sys.exit(1)
-        elif arg1 in ["--setuserinfo", "-su"]:
-            userinfo = " ".join(sys.argv[2:]).strip()
-            if userinfo == "":
-                print(f"Current userinfo is:\n{get_userinfo(config)}")
-            else:
-                set_userinfo(config, userinfo)
-                save_config(config)
-                print(f"Set userinfo to:\n{get_userinfo(config)}")
-            sys.exit(1)
-        elif arg1 in ["--clearuserinfo", "-cu"]:
-            set_userinfo(config, "[User has not set any userinfo]")
-            save_config(config)
-            print("Cleared userinfo.")
-            sys.exit(1)
-        elif arg1 in ["--continuous", "-c"]:
-            while True:
-                PROMPT = f"Ask {get_model(config)} >> "
-
-                query = input(PROMPT)
-                if query == "quit":
-                    print("Goodbye.")
-                    sys.exit(1)
-                else:
-                    run_query(query, config)
-        elif arg1 in ["--setprojectcontext", "-sp"]:
-            context = " ".join(sys.argv[2:]).strip()
-
-            if context == "":
-                print(f"CWD context is:\n{get_project_context(config, os.getcwd())}")
-            else:
-                set_project_context(config, os.getcwd(), context)
-                save_config(config)
-                print(
-                    f"Set CWD context to:\n{get_project_context(config, os.getcwd())}"
-                )
-            sys.exit(1)
-        elif arg1 in ["--clearprojectcontext", "-cp"]:
-            set_project_context(config, os.getcwd(), None)
-            save_config(config)
-            print("Cleared project context.")
-            sys.exit(1)
-
-    run_query(" ".join(sys.argv[1:]).strip(), config)
-
-
-def run_query(query, config) -> None:
-    if not query:
-        print_help()
+def print_help() -> None:
+    sys.stdout.write(_HELP_TEXT)
+
+
+def _help(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    print_help()
+
+
+def _clear_history(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    save_history(config, [])
+    save_config(config)
+    print("Cleared history.")
 
-    history = load_history() + [{"role": "user", "content": query}]
+
+@functools.lru_cache(maxsize=1)
+def _valid_models() -> frozenset:
+    # prefer the list generated by build_models.py so openai is never imported
+    try:
+        from _generated_models import VALID_MODELS
+
+        return VALID_MODELS
+    except ImportError:
+        pass
+
+    from openai.types import ChatModel
+    from typing_extensions import get_args
+
+    return frozenset(get_args(ChatModel))
+
+
+def _set_model(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    if arg2 is None:
+        print(f"Current model is: '{get_model(config)}'")
+        return
+
+    valid_models = _valid_models()
+    if arg2 not in valid_models:
+        print(f"Invalid model: '{arg2}'")
+        print(f"Must be one of:\n{'\n'.join(sorted(valid_models))}")
+        sys.exit(1)
+
+    set_model(config, arg2)
+    save_config(config)
+    print(f"Model set to: '{get_model(config)}'")
+
+
+def _set_history(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    if arg2 is None:
+        print(f"History length is: {get_history_length(config)}")
+        return
+
+    if not arg2.isdigit():
+        print(f"History length must be a number.")
+        sys.exit(1)
+
+    set_history_length(config, arg2)
+    save_config(config)
+    print(f"History length set to: {get_history_length(config)}")
+
+
+def _print_history(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    out = []
+    for entry in load_history(config):
+        if entry["role"] != "assistant":
+            out.append(format_wrapped(entry["content"], "# "))
+        else:
+            out.append(format_wrapped(entry["content"], "   # "))
+    sys.stdout.write("".join(out))
+
+
+def _set_userinfo(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    userinfo = rest
+    if userinfo == "":
+        print(f"Current userinfo is:\n{get_userinfo(config)}")
+    else:
+        set_userinfo(config, userinfo)
+        save_config(config)
+        print(f"Set userinfo to:\n{get_userinfo(config)}")
+
+
+def _clear_userinfo(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    set_userinfo(config, "[User has not set any userinfo]")
+    save_config(config)
+    print("Cleared userinfo.")
+
+
+def _continuous(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    _prefetch_client()
+    PROMPT = f"Ask {get_model(config)} >> "
     userinfo = get_userinfo(config)
     project_context = get_project_context(config, os.getcwd())
+    history = load_history(config)
+    while True:
+        query = input(PROMPT)
+        if query == "quit":
+            print("Goodbye.")
+            return
+        else:
+            history = run_query(query, config, history, userinfo, project_context)
+
+
+def _set_project_context(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    context = rest
+
+    if context == "":
+        print(f"CWD context is:\n{get_project_context(config, os.getcwd())}")
+    else:
+        set_project_context(config, os.getcwd(), context)
+        save_config(config)
+        print(f"Set CWD context to:\n{get_project_context(config, os.getcwd())}")
+
+
+def _clear_project_context(arg2: Optional[str], rest: str, config: DirtyConfig) -> None:
+    set_project_context(config, os.getcwd(), None)
+    save_config(config)
+    print("Cleared project context.")
+
+
+HANDLERS = {
+    "--help": _help,
+    "-h": _help,
+    "--clearhistory": _clear_history,
+    "-ch": _clear_history,
+    "--setmodel": _set_model,
+    "--sethistory": _set_history,
+    "--printhistory": _print_history,
+    "-ph": _print_history,
+    "--setuserinfo": _set_userinfo,
+    "-su": _set_userinfo,
+    "--clearuserinfo": _clear_userinfo,
+    "-cu": _clear_userinfo,
+    "--continuous": _continuous,
+    "-c": _continuous,
+    "--setprojectcontext": _set_project_context,
+    "-sp": _set_project_context,
+    "--clearprojectcontext": _clear_project_context,
+    "-cp": _clear_project_context,
+}
 
-    response = CLIENT.chat.completions.create(
+
+def main() -> None:
+    argv = sys.argv
+    argc = len(argv)
+    arg1 = argv[1] if argc > 1 else None
+    arg2 = argv[2] if argc > 2 else None
+    rest = " ".join(argv[2:]).strip() if argc > 2 else ""
+
+    handler = HANDLERS.get(arg1)
+    if handler is not None:
+        handler(arg2, rest, load_config())
+        sys.exit(0)
+
+    full = f"{arg1} {rest}".strip() if arg1 is not None else ""
+    run_query(full, load_config())
+
+
+def wrap(text: str, width: int = _TERM_W) -> list[str]:
+    # hard-wraps at the terminal width; cheaper than textwrap for long answers
+    text = text.expandtabs()
+    width = max(width, 1)
+    if len(text) <= width:
+        return [text]
+    return [text[i : i + width] for i in range(0, len(text), width)]
+
+
+def format_wrapped(text: str, prefix: str = "# ") -> str:
+    return "".join(
+        f"{prefix}{line2}\n" for line in text.split("\n") for line2 in wrap(line)
+    )
+
+
+def write_wrapped(text: str) -> None:
+    sys.stdout.write(format_wrapped(text))
+    sys.stdout.flush()
+
+
+def run_query(
+    query,
+    config,
+    history: Optional[list] = None,
+    userinfo: Optional[str] = None,
+    project_context: Optional[str] = None,
+) -> list:
+    if not query:
+        print_help()
+        sys.exit(1)
+
+    if history is None:
+        history = load_history(config)
+    history = history + [{"role": "user", "content": query}]
+    if userinfo is None:
+        userinfo = get_userinfo(config)
+    if project_context is None:
+        project_context = get_project_context(config, os.getcwd())
+
+    messages = [
+        _SYSTEM_MSG,
+        {
+            "role": "system",
+            "content": f'The user provided the following information about themself or their system or platform for context: "{userinfo}"',
+        },
+        {
+            "role": "system",
+            "content": f'The user provided the following information about the current project / working directory for context: "{project_context}"',
+        },
+    ]
+    messages.extend(history)
+
+    response = _client().chat.completions.create(
         model=get_model(config),
-        messages=[
-            {
-                "role": "system",
-                "content": "You are an assistant contacted via a 'howto' CLI command. Questions may be formatted weirdly. If so, assume each question is preceded with 'how to' or similar. If the question can be answered in one or two sentences without immediately important information, keep responses short.",
-            },
-            {
-                "role": "system",
-                "content": f'The user provided the following information about themself or their system or platform for context: "{userinfo}"',
-            },
-            {
-                "role": "system",
-                "content": f'The user provided the following information about the current project / working directory for context: "{project_context}"',
-            },
-        ]
-        + history,
+        messages=messages,
+        stream=True,
     )
 
-    answer = response.choices[0].message.content
-    if not answer:
+    # print each line as soon as it is complete instead of waiting for the
+    # whole response; the opening marker waits for the first content so an
+    # empty response prints nothing
+    parts = []
+    pending = ""
+    for chunk in response:
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if not content:
+            continue
+        if not parts:
+            sys.stdout.write("#\n")
+        parts.append(content)
+        pending += content
+        complete, sep, pending = pending.rpartition("\n")
+        if sep:
+            write_wrapped(complete)
+    if not parts:
         raise ValueError("OpenAI response is empty")
-    lines = answer.split("\n")
-    print(f"#")
-    wrapper = textwrap.TextWrapper(
-        width=os.get_terminal_size().columns - 6, drop_whitespace=False
-    )
-    for line in lines:
-        for line2 in wrapper.wrap(line):
-            print(f"# {line2}")
-    print("#")
+    if pending:
+        write_wrapped(pending)
+    sys.stdout.write("#\n")
+
+    answer = "".join(parts)
 
     history.append({"role": "assistant", "content": answer})
 
-    save_history(history[-int(config["ai model"]["history"]) :])
+    history = history[-int(config["ai model"]["history"]) :]
+    save_history(config, history)
     save_config(config)
+    return history
 
 
-if __name__ == "__main__":
+def cli() -> None:
     try:
         main()
     except KeyboardInterrupt as e:
         # gotta do this otherwise shell prompt looks ugly upon KeyboardInterrupt
         print("")
         sys.exit(1)
+
+
+if __name__ == "__main__":
+    cli()